@@ -1,6 +1,11 @@
-import inspect
+"""
+pytest plugin that allows multiple failures per test, via pytest.assume().
+"""
+import argparse
+import io
+import linecache
 import os.path
-from six import reraise as raise_
+import sys
 
 import pytest
 
@@ -9,14 +14,50 @@ try:
 except ImportError:
     saferepr = repr
 
-_FAILED_ASSUMPTIONS = []
-_ASSUMPTION_LOCALS = []
+_ENTRY_TMPL = "%s:%s: AssumptionFailure\n>>\t%s"
+# Set from the config in pytest_configure.
+_SHOWLOCALS = False
+_MAX_REPR_LEN = None
+_MAX_FAILURES = None
+# Failed assumptions show their file relative to the cwd at configure time.
+_RELPATH_START = None
+# Values of the above for enclosing runs, restored by pytest_unconfigure
+# when a nested in-process run ends.
+_SAVED_OPTIONS = []
+# Source filename -> path relative to _RELPATH_START. Cleared whenever that
+# changes, so tests changing the cwd (monkeypatch.chdir) don't affect it.
+_RELPATH_CACHE = {}
 
 
 class FailedAssumption(Exception):
     pass
 
 
+class _Assumptions(object):
+    """
+    Failed assumptions, and their locals if showlocals is set,
+    collected while running a single test item. Failures past
+    --assume-max-failures are only counted.
+    """
+    __slots__ = ("failed", "locals", "truncated")
+
+    def __init__(self):
+        self.failed = []
+        self.locals = []
+        self.truncated = 0
+
+
+# Stack of assumption records, one per running test item, the current one last.
+# Nested runs (e.g. pytester's runpytest_inprocess) push their own records, so
+# they never see the calling test's assumptions. It is shared by all threads,
+# so assumptions made from threads a test starts are reported for that test.
+# Each run also pushes a record of its own, which catches assumptions made
+# outside of any of its test items (e.g. at import) and is handed over to the
+# next item, so they still get reported. The bottom record catches anything
+# made outside of a run.
+_ASSUMPTION_STACK = [_Assumptions()]
+
+
 def assume(expr, msg=''):
     """
     Checks the expression, if it's false, add it to the
@@ -25,40 +66,147 @@ def assume(expr, msg=''):
 
     :param expr: Expression to 'assert' on.
     :param msg: Message to display if the assertion fails.
-    :return: None
-    """
-    if not expr:
-        (frame, filename, line, funcname, contextlist) = inspect.stack()[1][0:5]
-        # get filename, line, and context
-        filename = os.path.relpath(filename)
-        context = contextlist[0].lstrip() if not msg else msg
-        # format entry
-        entry = u"{filename}:{line}: AssumptionFailure\n>>\t{context}".format(**locals())
-        # add entry
-        _FAILED_ASSUMPTIONS.append(entry)
-        if getattr(pytest, "_showlocals", None):
-            # Debatable whether we should display locals for
-            # every failed assertion, or just the final one.
-            # I'm defaulting to per-assumption, just because vars
-            # can easily change between assumptions.
-            pretty_locals = ["\t%-10s = %s" % (name, saferepr(val))
-                             for name, val in frame.f_locals.items()]
-            _ASSUMPTION_LOCALS.append(pretty_locals)
+    :return: True if the expression is true, False otherwise.
+    """
+    return True if expr else _assume_fail(msg)
+
 
+# Records a failed assumption made by the caller of assume(), and returns False.
+# Kept out of assume(), and without a docstring, so both code objects stay
+# small. The keyword arguments only bind globals as fast locals.
+def _assume_fail(msg, _getframe=sys._getframe, _relpath=os.path.relpath,
+                 _relpath_cache=_RELPATH_CACHE, _stack=_ASSUMPTION_STACK):
+    record = _stack[-1]
+    if _MAX_FAILURES is not None and len(record.failed) >= _MAX_FAILURES:
+        record.truncated += 1
         return False
+    # Only the frame that called assume() is needed; inspect.stack() would
+    # walk (and read the source of) every frame on the stack.
+    frame = _getframe(2)
+    filename = frame.f_code.co_filename
+    line = frame.f_lineno
+    if msg:
+        # The message replaces the source line, so don't read the source.
+        context = msg
     else:
-        return True
+        # Empty if there's no source, e.g. for exec'd code.
+        context = linecache.getline(filename, line, frame.f_globals).lstrip()
+    try:
+        relpath = _relpath_cache[filename]
+    except KeyError:
+        # Relative names (e.g. '<string>') have no directory to be relative to.
+        relpath = _relpath_cache[filename] = (_relpath(filename, _RELPATH_START)
+                                              if os.path.isabs(filename) else filename)
+    record.failed.append(_ENTRY_TMPL % (relpath, line, context))
+    if _SHOWLOCALS:
+        # Debatable whether we should display locals for
+        # every failed assertion, or just the final one.
+        # I'm defaulting to per-assumption, just because vars
+        # can easily change between assumptions.
+        # So format them now, rather than holding on to the objects.
+        record.locals.append(_format_locals(frame.f_locals, _MAX_REPR_LEN))
+    return False
 
 
-def pytest_configure(config):
+def _format_locals(flocals, max_len=None):
+    """
+    Format locals for display, truncating each repr. Private names and
+    callables (helpers, classes, ...) are left out.
+
+    :param flocals: Dictionary of local name: value.
+    :param max_len: Maximum length of each repr, or None for no limit.
+    :return: Formatted locals, one per line.
+    """
+    return "\n".join(["\t%-10s = %s" % (name, saferepr(val)[:max_len])
+                      for name, val in flocals.items()
+                      if not name.startswith("_") and not callable(val)])
+
+
+def _int_at_least(minimum):
+    """
+    Build an argparse type that only accepts integers >= minimum.
+
+    :param minimum: Smallest accepted value.
+    :return: Conversion function for the 'type' of an option.
     """
-    Add tracking lists to the pytest namespace, so we can
-    always access it, as well as the 'assume' function itself.
+    def convert(value):
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid int value: %r" % value)
+        if number < minimum:
+            raise argparse.ArgumentTypeError("must be at least %s, got %s" % (minimum, number))
+        return number
+    return convert
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("assume")
+    group.addoption("--assume-max-repr-len", action="store", type=_int_at_least(0),
+                    default=None, dest="assume_max_repr_len",
+                    help="truncate the repr of each local shown for a failed "
+                         "assumption to this many characters (default, or 0: no limit).")
+    group.addoption("--assume-max-failures", action="store", type=_int_at_least(1),
+                    default=None, dest="assume_max_failures",
+                    help="only record this many failed assumptions per test, "
+                         "and just count the rest (default: no limit).")
+
 
-    :return: Dictionary of name: values added to the pytest namespace.
+def pytest_configure(config):
+    """
+    Add the 'assume' function to the pytest namespace, and read the
+    options assume() needs once, rather than on every failure.
     """
+    global _SHOWLOCALS, _MAX_REPR_LEN, _MAX_FAILURES
     pytest.assume = assume
-    pytest._showlocals = config.getoption("showlocals")
+    _SAVED_OPTIONS.append((_SHOWLOCALS, _MAX_REPR_LEN, _MAX_FAILURES, _RELPATH_START))
+    _set_relpath_start(os.getcwd())
+    _SHOWLOCALS = config.getoption("showlocals")
+    # 0 means no limit, like not passing the option.
+    _MAX_REPR_LEN = config.getoption("assume_max_repr_len") or None
+    _MAX_FAILURES = config.getoption("assume_max_failures")
+    _ASSUMPTION_STACK.append(_Assumptions())
+
+
+def pytest_unconfigure(config):
+    """
+    Drop the run's record, pushed in pytest_configure, and restore the
+    options of the enclosing run, if any.
+    """
+    global _SHOWLOCALS, _MAX_REPR_LEN, _MAX_FAILURES
+    _ASSUMPTION_STACK.pop()
+    _SHOWLOCALS, _MAX_REPR_LEN, _MAX_FAILURES, start = _SAVED_OPTIONS.pop()
+    _set_relpath_start(start)
+
+
+def _set_relpath_start(start):
+    """
+    Show the files of failed assumptions relative to start from now on.
+
+    :param start: Directory, or None for the cwd at each failure.
+    """
+    global _RELPATH_START
+    if start != _RELPATH_START:
+        _RELPATH_CACHE.clear()
+        _RELPATH_START = start
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    """
+    Give each test item its own assumption record, covering its fixtures
+    as well as the test call itself. Anything that failed outside of a test
+    item since the last one started is reported with this one.
+    """
+    # Items don't nest within a run, so the top record is the run's own.
+    record = _Assumptions()
+    if _ASSUMPTION_STACK[-1].failed:
+        record, _ASSUMPTION_STACK[-1] = _ASSUMPTION_STACK[-1], record
+    _ASSUMPTION_STACK.append(record)
+    try:
+        yield
+    finally:
+        _ASSUMPTION_STACK.pop()
 
 
 @pytest.hookimpl(hookwrapper=True)
@@ -71,26 +219,60 @@ def pytest_pyfunc_call(pyfuncitem):
     Note: I'm not happy with exception handling in here.
     """
     __tracebackhide__ = True
-    outcome = None
-    try:
-        outcome = yield
-    finally:
-        failed_assumptions = _FAILED_ASSUMPTIONS
-        assumption_locals = _ASSUMPTION_LOCALS
-        if failed_assumptions:
-            failed_count = len(failed_assumptions)
-            root_msg = "\n%s Failed Assumptions:\n" % failed_count
-            if assumption_locals:
-                assume_data = zip(failed_assumptions, assumption_locals)
-                longrepr = ["{0}\nLocals:\n{1}\n\n".format(assumption, "\n".join(flocals))
-                            for assumption, flocals in assume_data]
-            else:
-                longrepr = ["\n\n".join(failed_assumptions)]
-
-            del _FAILED_ASSUMPTIONS[:]
-            del _ASSUMPTION_LOCALS[:]
-            if outcome and outcome.excinfo:
-                root_msg = "\nOriginal Failure: \n>> %s\n" % repr(outcome.excinfo[1]) + root_msg
-                raise_(FailedAssumption, FailedAssumption(root_msg + "".join(longrepr)), outcome.excinfo[2])
-            else:
-                raise FailedAssumption(root_msg + "".join(longrepr))
+    outcome = yield
+    record = _ASSUMPTION_STACK[-1]
+    if record.failed:
+        _raise_failed_assumptions(record, outcome.excinfo)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item, nextitem):
+    """
+    Report what's left on the item's record once its fixtures are torn down:
+    assumptions that failed in fixture teardown, or in setup when the test
+    itself never ran. Otherwise they'd be dropped with the record.
+    """
+    __tracebackhide__ = True
+    outcome = yield
+    record = _ASSUMPTION_STACK[-1]
+    if record.failed:
+        _raise_failed_assumptions(record, outcome.excinfo)
+
+
+def _raise_failed_assumptions(record, excinfo):
+    """
+    Clear the record, and raise FailedAssumption listing what was in it.
+
+    :param record: _Assumptions with at least one failure.
+    :param excinfo: Exception info of the original failure, if any.
+    """
+    __tracebackhide__ = True
+    failed_assumptions = record.failed
+    truncated = record.truncated
+    failed_count = len(failed_assumptions) + truncated
+    # Write the report piece by piece rather than building (and then
+    # concatenating) a string per failed assumption.
+    buf = io.StringIO()
+    if excinfo:
+        buf.write("\nOriginal Failure: \n>> %s\n" % repr(excinfo[1]))
+    buf.write("\n%s Failed Assumptions:\n" % failed_count)
+    # Locals are only ever recorded with showlocals, so check the flag first
+    # and leave record.locals alone in the default configuration.
+    if _SHOWLOCALS and record.locals:
+        for assumption, flocals in zip(failed_assumptions, record.locals):
+            buf.write(assumption)
+            buf.write("\nLocals:\n")
+            buf.write(flocals)
+            buf.write("\n\n")
+    else:
+        buf.write("\n\n".join(failed_assumptions))
+    if truncated:
+        buf.write("\n... %s more Failed Assumptions not shown\n" % truncated)
+
+    record.failed.clear()
+    record.locals.clear()
+    record.truncated = 0
+    if excinfo:
+        raise FailedAssumption(buf.getvalue()).with_traceback(excinfo[2])
+    else:
+        raise FailedAssumption(buf.getvalue())
@@ -15,6 +15,7 @@ setup(
     license='MIT',
     keywords=['testing', 'pytest', 'assert'],
     install_requires=['pytest>=2.7'],
+    python_requires='>=3.4',
     download_url='https://github.com/astraw38/pytest-assume/tarball/2.0.0',
     url='https://github.com/astraw38/pytest-assume',
     classifiers=[
@@ -22,6 +23,7 @@ setup(
         'Topic :: Software Development :: Testing',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
     ],
     # the following makes a plugin available to py.test
     entry_points={'pytest11': ['assume = pytest_assume.plugin']}
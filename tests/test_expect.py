@@ -1,3 +1,5 @@
+import os
+
 pytest_plugins = "pytester",
 
 
@@ -43,6 +45,71 @@ def test_multi_pass_one_failing_expect(testdir):
     assert '2 Failed Assumptions' in result.stdout.str()
 
 
+def test_max_failures(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_func():
+            for i in range(5):
+                pytest.assume(i < 0, 'i:%s' % i)
+        """)
+    result = testdir.runpytest_inprocess("--assume-max-failures=2")
+    result.assert_outcomes(0, 0, 1)
+    stdout = result.stdout.str()
+    assert '5 Failed Assumptions' in stdout
+    assert 'i:1' in stdout
+    assert 'i:2' not in stdout
+    assert '3 more Failed Assumptions not shown' in stdout
+
+
+def test_max_failures_rejects_zero(testdir):
+    testdir.makepyfile(
+        """
+        def test_func():
+            pass
+        """)
+    result = testdir.runpytest_inprocess("--assume-max-failures=0")
+    assert result.ret != 0
+    assert 'must be at least 1, got 0' in result.stderr.str()
+
+
+def test_relpath_cache_keyed_by_source_filename(testdir):
+    testdir.makepyfile(
+        """
+        import os
+        import pytest
+        from pytest_assume import plugin
+
+        def test_func():
+            pytest.assume(1 == 2)
+            assert plugin._RELPATH_CACHE[__file__] == os.path.basename(__file__)
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 1)
+    assert '1 Failed Assumptions' in result.stdout.str()
+    assert 'Original Failure' not in result.stdout.str()
+
+
+def test_relpath_ignores_chdir(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        def test_chdir(monkeypatch, tmpdir):
+            monkeypatch.chdir(tmpdir)
+            pytest.assume(1 == 2)
+
+        def test_after():
+            pytest.assume(1 == 2)
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 2)
+    stdout = result.stdout.str()
+    assert 'test_relpath_ignores_chdir.py:5: AssumptionFailure' in stdout
+    assert 'test_relpath_ignores_chdir.py:8: AssumptionFailure' in stdout
+    assert '..' + os.sep not in stdout
+
+
 def test_passing_expect_doesnt_cloak_assert(testdir):
     testdir.makepyfile(
         """
@@ -104,6 +171,47 @@ def test_msg_is_in_output(testdir):
     assert 'a:1 b:2' in result.stdout.str()
 
 
+def test_msg_does_not_read_source(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        import pytest_assume.plugin
+
+        class Linecache(object):
+            def __init__(self):
+                self.calls = []
+
+            def getline(self, *args):
+                self.calls.append(args)
+                return ''
+
+        def test_func(monkeypatch):
+            linecache = Linecache()
+            monkeypatch.setattr(pytest_assume.plugin, "linecache", linecache)
+            pytest.assume(1 == 2, 'custom message')
+            assert linecache.calls == []
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 1)
+    assert '1 Failed Assumptions' in result.stdout.str()
+    assert 'custom message' in result.stdout.str()
+    assert 'Original Failure' not in result.stdout.str()
+
+
+def test_without_source(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        def test_func():
+            exec(compile("pytest.assume(1 == 2)", "<generated>", "exec"))
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 1)
+    assert '1 Failed Assumptions' in result.stdout.str()
+    assert '<generated>:1: AssumptionFailure' in result.stdout.str()
+
+
 def test_with_locals(testdir):
     testdir.makepyfile(
         """
@@ -122,6 +230,71 @@ def test_with_locals(testdir):
     assert "b          = 2" in stdout
 
 
+def test_with_locals_at_each_assumption(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_func():
+            x = []
+            for i in range(3):
+                x.append(i)
+                pytest.assume(i < 0)
+        """)
+    result = testdir.runpytest_inprocess("--showlocals")
+    result.assert_outcomes(0, 0, 1)
+    stdout = result.stdout.str()
+    assert '3 Failed Assumptions' in stdout
+    assert "x          = [0]\n" in stdout
+    assert "x          = [0, 1]\n" in stdout
+    assert "x          = [0, 1, 2]\n" in stdout
+
+
+def test_with_locals_skips_private_and_callables(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_func():
+            a = 1
+            _b = 2
+            def helper():
+                pass
+            pytest.assume(a == _b)
+        """)
+    result = testdir.runpytest_inprocess("--showlocals")
+    result.assert_outcomes(0, 0, 1)
+    stdout = result.stdout.str()
+    assert '1 Failed Assumptions' in stdout
+    assert "a          = 1" in stdout
+    assert "_b         = 2" not in stdout
+    assert "helper     = " not in stdout
+
+
+def test_with_locals_max_repr_len(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_func():
+            a = "x" * 100
+            pytest.assume(a == "")
+        """)
+    result = testdir.runpytest_inprocess("--showlocals", "--assume-max-repr-len=10")
+    result.assert_outcomes(0, 0, 1)
+    stdout = result.stdout.str()
+    assert '1 Failed Assumptions' in stdout
+    assert "a          = 'xxxxxxxxx\n" in stdout
+
+
+def test_max_repr_len_rejects_negative(testdir):
+    testdir.makepyfile(
+        """
+        def test_func():
+            pass
+        """)
+    result = testdir.runpytest_inprocess("--assume-max-repr-len=-3")
+    assert result.ret != 0
+    assert 'must be at least 0, got -3' in result.stderr.str()
+
+
 def test_without_locals(testdir):
     testdir.makepyfile(
         """
@@ -168,6 +341,158 @@ def test_xpass_assumption(testdir):
 
 
 
+def test_assumption_in_fixture(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def value():
+            pytest.assume(1 == 2, 'from fixture')
+            return 1
+
+        def test_func(value):
+            pytest.assume(value == 1)
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 1)
+    assert '1 Failed Assumptions' in result.stdout.str()
+    assert 'from fixture' in result.stdout.str()
+
+
+def test_assumption_at_import(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        pytest.assume(1 == 2, 'at import')
+
+        def test_a():
+            pass
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 1)
+    assert '1 Failed Assumptions' in result.stdout.str()
+    assert 'at import' in result.stdout.str()
+
+
+def test_assumption_in_thread(testdir):
+    testdir.makepyfile(
+        """
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        import pytest
+
+        def test_thread():
+            thread = threading.Thread(target=lambda: pytest.assume(1 == 2))
+            thread.start()
+            thread.join()
+
+        def test_executor():
+            with ThreadPoolExecutor(2) as executor:
+                list(executor.map(pytest.assume, [False, False]))
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 2)
+    stdout = result.stdout.str()
+    assert '1 Failed Assumptions' in stdout
+    assert '2 Failed Assumptions' in stdout
+
+
+def test_assumption_in_fixture_teardown(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def value():
+            yield 1
+            pytest.assume(1 == 2, 'from teardown')
+
+        def test_func(value):
+            pass
+
+        def test_other():
+            pass
+        """)
+    result = testdir.runpytest_inprocess()
+    outcomes = result.parseoutcomes()
+    assert outcomes.get("passed", 0) == 2
+    assert outcomes.get("errors", outcomes.get("error", 0)) == 1
+    stdout = result.stdout.str()
+    assert 'ERROR at teardown of test_func' in stdout
+    assert 'from teardown' in stdout
+
+
+def test_assumption_in_setup_of_skipped_test(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture
+        def value():
+            pytest.assume(1 == 2, 'from setup')
+            pytest.skip('not today')
+
+        def test_func(value):
+            pass
+
+        def test_other():
+            pass
+        """)
+    result = testdir.runpytest_inprocess()
+    outcomes = result.parseoutcomes()
+    assert outcomes.get("skipped", 0) == 1
+    assert outcomes.get("passed", 0) == 1
+    assert outcomes.get("errors", outcomes.get("error", 0)) == 1
+    stdout = result.stdout.str()
+    assert 'ERROR at teardown of test_func' in stdout
+    assert 'from setup' in stdout
+
+
+def test_nested_run_has_own_assumptions(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        pytest_plugins = "pytester"
+
+        def test_func(testdir):
+            testdir.makepyfile("def test_inner(): pass")
+            pytest.assume(1 == 2, 'from outer')
+            result = testdir.runpytest_inprocess()
+            result.assert_outcomes(1, 0, 0)
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 1)
+    stdout = result.stdout.str()
+    assert '1 Failed Assumptions' in stdout
+    assert 'from outer' in stdout
+    assert 'AssertionError' not in stdout
+
+
+def test_nested_run_keeps_own_options(testdir):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        pytest_plugins = "pytester"
+
+        def test_func(testdir):
+            testdir.makepyfile("def test_inner(): pass")
+            result = testdir.runpytest_inprocess("--assume-max-failures=1", "--showlocals")
+            result.assert_outcomes(1, 0, 0)
+            pytest.assume(1 == 2)
+            pytest.assume(1 == 3)
+        """)
+    result = testdir.runpytest_inprocess()
+    result.assert_outcomes(0, 0, 1)
+    stdout = result.stdout.str()
+    assert '2 Failed Assumptions' in stdout
+    assert 'Locals:' not in stdout
+    assert 'not shown' not in stdout
+
+
 def test_bytecode(testdir):
     testdir.makepyfile(
         b"""